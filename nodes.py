@@ -1,7 +1,12 @@
 import os
+import bisect
+import math
 import random
+import functools
+import itertools
 import time
 import logging
+from collections import OrderedDict
 from pathlib import Path
 from typing import Optional, Tuple
 import folder_paths
@@ -9,6 +14,38 @@ import re
 
 logger = logging.getLogger(__name__)
 
+_COMMENT_RE = re.compile(r"/\*.*?\*/|//[^\n]*", re.DOTALL)
+_CHOICE_TOKEN_RE = re.compile(r"[{|}]")
+_WILDCARD_RE = re.compile(r"__(.*?)__", re.DOTALL)
+_WEIGHT_RE = re.compile(r"^\s*(\d+(?:\.\d+)?)::(.*)$")
+# Tamaño a partir del cual los comodines se leen línea a línea
+_STREAM_MIN_SIZE = 64 * 1024
+# Patrones de _limit_blank_lines, compilados una vez por cada límite
+_BLANK_LINES_RE_CACHE: dict[int, re.Pattern] = {}
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_weighted(choices: tuple[str, ...]) -> tuple[tuple[str, ...], tuple[float, ...]]:
+    """Split "peso::texto" options into their texts and cumulative weights"""
+    parsed_choices = []
+    weights = []
+
+    for c in choices:
+        # Detectar formato "peso::texto"
+        match = _WEIGHT_RE.match(c)
+        if match:
+            weight = float(match.group(1))
+            text = match.group(2).strip()
+        else:
+            weight = 1.0
+            text = c.strip()
+
+        parsed_choices.append(text)
+        weights.append(weight)
+
+    return tuple(parsed_choices), tuple(itertools.accumulate(weights))
+
+
 class RandomPromptsMyTest:
     """
     Ultimate random prompts node with:
@@ -19,12 +56,25 @@ class RandomPromptsMyTest:
     - Configurable limit of consecutive blank lines
     """
 
+    # Número máximo de resultados de _process_choices guardados por nodo
+    _CHOICES_CACHE_SIZE = 128
+    # Pasadas máximas para comodines que contienen otros comodines
+    _MAX_WILDCARD_PASSES = 8
+    # Cargar todos los comodines al crear el nodo en lugar de bajo demanda
+    PRELOAD_WILDCARDS = False
+    # Opciones de cada comodín por nombre, con el mtime del fichero leído;
+    # compartidas entre nodos
+    _wildcards_cache: dict[str, tuple[int, tuple[str, ...]]] = {}
+
     def __init__(self):
         self._random = random.Random()
         self._last_seed = None
-        self._choice_history = {}
-        self._wildcards_cache = {}
+        # Semilla recién aplicada mientras el generador no se haya usado
+        self._fresh_seed = None
+        self._choices_cache = OrderedDict()
         self._wildcards_path = self._get_wildcards_path()
+        if self.PRELOAD_WILDCARDS:
+            self._preload_wildcards()
 
     def _get_wildcards_path(self) -> Optional[Path]:
         """Get path to wildcards folder"""
@@ -33,147 +83,237 @@ class RandomPromptsMyTest:
         wildcards_path.mkdir(exist_ok=True)
         return wildcards_path
 
-    def _load_wildcard_file(self, wildcard: str) -> list[str]:
-        """Load wildcard file if exists"""
+    def _load_wildcard_file(self, wildcard: str) -> tuple[str, ...]:
+        """Load wildcard file if exists, reusing the cached options while the
+        file is unchanged"""
         if not self._wildcards_path:
-            return []
-            
+            return ()
+
         wildcard_file = (self._wildcards_path / f"{wildcard}.txt")
-        if wildcard_file.exists():
-            try:
-                with open(wildcard_file, "r", encoding="utf-8") as f:
-                    return [line.strip() for line in f.readlines() if line.strip()]
-            except Exception as e:
-                logger.warning(f"Failed to load wildcard file {wildcard}: {e}")
-        return []
+        try:
+            stat = wildcard_file.stat()
+        except (OSError, ValueError):
+            return ()
+
+        cached = self._wildcards_cache.get(wildcard)
+        if cached is not None and cached[0] == stat.st_mtime_ns:
+            return cached[1]
+
+        return self._cache_wildcard_file(wildcard, wildcard_file, stat)
+
+    def _preload_wildcards(self):
+        """Load every .txt file of the wildcards folder in a single scan"""
+        if not self._wildcards_path:
+            return
+
+        try:
+            with os.scandir(self._wildcards_path) as entries:
+                for entry in entries:
+                    if not entry.name.endswith(".txt") or not entry.is_file():
+                        continue
+                    wildcard, stat = entry.name[:-4], entry.stat()
+                    cached = self._wildcards_cache.get(wildcard)
+                    if cached is None or cached[0] != stat.st_mtime_ns:
+                        self._cache_wildcard_file(wildcard, Path(entry.path), stat)
+        except OSError as e:
+            logger.warning(f"Failed to preload wildcards: {e}")
+
+    def _cache_wildcard_file(self, wildcard: str, wildcard_file: Path,
+                             stat: os.stat_result) -> tuple[str, ...]:
+        """Read a wildcard file and store its options with its mtime"""
+        try:
+            options = self._read_wildcard_file(wildcard_file, stat.st_size)
+        except Exception as e:
+            logger.warning(f"Failed to load wildcard file {wildcard}: {e}")
+            options = ()
+
+        # Reemplaza la entrada de una versión anterior del fichero
+        self._wildcards_cache[wildcard] = (stat.st_mtime_ns, options)
+        return options
+
+    @staticmethod
+    def _read_wildcard_file(wildcard_file: Path, size: int) -> tuple[str, ...]:
+        """Read the non-empty, stripped lines of a wildcard file"""
+        if size <= _STREAM_MIN_SIZE:
+            # Como readlines(): solo '\n' (los '\r' ya se han normalizado)
+            lines = wildcard_file.read_text(encoding="utf-8").split("\n")
+            return tuple(line for line in map(str.strip, lines) if line)
+
+        # Diccionarios grandes: leer línea a línea, sin cargar el texto entero
+        # (el modo texto corta las líneas igual que la rama anterior)
+        with open(wildcard_file, "r", encoding="utf-8") as f:
+            return tuple(line for line in map(str.strip, f) if line)
 
     def _process_wildcards(self, text: str) -> str:
         """Process __wildcard__ syntax"""
-        while "__" in text:
-            start = text.find("__")
-            end = text.find("__", start + 2)
-            if end == -1:
-                break
-                
-            wildcard_name = text[start+2:end]
-            
-            if wildcard_name not in self._wildcards_cache:
-                self._wildcards_cache[wildcard_name] = self._load_wildcard_file(wildcard_name)
-                
-            options = self._wildcards_cache[wildcard_name]
+        # Enlaces locales: se usan una vez por comodín encontrado
+        load_wildcard = self._load_wildcard_file
+        choose = self._random.choice
+
+        def replace(match: re.Match) -> str:
+            wildcard_name = match.group(1)
+            options = load_wildcard(wildcard_name)
             if options:
-                replacement = self._random.choice(options)
-                text = text[:start] + replacement + text[end+2:]
-            else:
-                text = text[:start] + wildcard_name + text[end+2:]
-                
-        return text
+                self._fresh_seed = None
+                return choose(options)
+            return wildcard_name
 
-    def _reset_history(self):
-        """Reset choice history"""
-        self._choice_history = {}
+        # Las opciones pueden contener a su vez otros comodines
+        for _ in range(self._MAX_WILDCARD_PASSES):
+            if "__" not in text:
+                break
+            text, count = _WILDCARD_RE.subn(replace, text)
+            if not count:
+                break
 
-    def _get_weighted_choice(self, choices: list[str], choice_block_id: str) -> str:
+        return text
+
+    def _get_weighted_choice(self, choices: tuple[str, ...]) -> str:
         """
         Selecciona una opción con pesos definidos como:
         {5::sunny|2::cloudy|1::rainy}
         """
-        parsed_choices = []
-        weights = []
-
-        for c in choices:
-            # Detectar formato "peso::texto"
-            match = re.match(r"^\s*(\d+(?:\.\d+)?)::(.*)$", c)
-            if match:
-                weight = float(match.group(1))
-                text = match.group(2).strip()
-            else:
-                weight = 1.0
-                text = c.strip()
-
-            parsed_choices.append(text)
-            weights.append(weight)
+        parsed_choices, cum_weights = _parse_weighted(choices)
+        total = cum_weights[-1]
+        if total <= 0.0:
+            raise ValueError("Total of weights must be greater than zero")
+        if not math.isfinite(total):
+            raise ValueError("Total of weights must be finite")
 
-        # Elegir con probabilidad ponderada
-        selected = self._random.choices(parsed_choices, weights=weights, k=1)[0]
-        return selected
+        # Elegir con probabilidad ponderada: lo mismo que random.choices(k=1)
+        # con cum_weights, sin su validación ni la lista intermedia
+        index = bisect.bisect(cum_weights, self._random.random() * total, 0, len(cum_weights) - 1)
+        return parsed_choices[index]
 
     def _process_choices(self, text: str) -> str:
-        """Main processing function that handles both simple and nested choices,
-        ignoring // line comments and /* block comments */."""
-        
-        # 1. Eliminar comentarios
-        text = re.sub(r"/\*.*?\*/", "", text, flags=re.DOTALL)
-        text = re.sub(r"//.*", "", text)
+        """LRU-cached front-end of _expand_choices.
+
+        Results are only cached while the generator is still in the state
+        set by an explicit seed, so (text, seed) is enough as key. A hit
+        replays the random() calls of the expansion, keeping the random
+        sequence identical to an uncached run."""
+        # Sin bloques no hay nada que procesar
+        if "{" not in text:
+            return text
+
+        seed = self._fresh_seed
+        self._fresh_seed = None
+        if seed is None:
+            return self._expand_choices(text)[0]
+
+        key = (text, seed)
+        cached = self._choices_cache.get(key)
+        if cached is not None:
+            self._choices_cache.move_to_end(key)
+            result, draws = cached
+            rnd = self._random.random
+            for _ in range(draws):
+                rnd()
+            return result
+
+        result, draws = self._expand_choices(text)
+        self._choices_cache[key] = (result, draws)
+        if len(self._choices_cache) > self._CHOICES_CACHE_SIZE:
+            self._choices_cache.popitem(last=False)
+        return result
+
+    def _expand_choices(self, text: str) -> tuple[str, int]:
+        """Main processing function that handles both simple and nested choices.
+        Returns the expanded text and the number of random() calls made.
+
+        Comments must already be removed (see _strip_comments). The text is
+        parsed in a single left-to-right pass with an explicit stack of open
+        blocks: '{' opens a block, '|' closes the current option and '}'
+        selects one option and hands it to the enclosing block (or to the
+        output)."""
+
+        # Enlaces locales: se usan una vez por bloque
+        join_choice = self._join_choice
+        weighted_choice = self._get_weighted_choice
 
         result = []
-        i = 0
-        while i < len(text):
-            if text[i] == "{":
-                # Buscar cierre correspondiente
-                brace_level = 1
-                j = i + 1
-                while j < len(text) and brace_level > 0:
-                    if text[j] == "{":
-                        brace_level += 1
-                    elif text[j] == "}":
-                        brace_level -= 1
-                    j += 1
-
-                if brace_level == 0:
-                    choice_block = text[i:j]
-                    inner_content = choice_block[1:-1]
-
-                    # Dividir las opciones por '|', manejando anidamientos
-                    choices = []
-                    current_choice = []
-                    nested_level = 0
-
-                    for char in inner_content:
-                        if char == "{":
-                            nested_level += 1
-                            current_choice.append(char)
-                        elif char == "}":
-                            nested_level -= 1
-                            current_choice.append(char)
-                        elif char == "|" and nested_level == 0:
-                            choices.append("".join(current_choice).strip())
-                            current_choice = []
-                        else:
-                            current_choice.append(char)
-
-                    if current_choice:
-                        choices.append("".join(current_choice).strip())
-
-                    # Procesar recursivamente
-                    processed_choices = []
-                    for choice in choices:
-                        if "{" in choice:
-                            processed_choices.append(self._process_choices(choice))
-                        else:
-                            processed_choices.append(choice)
-
-                    # Seleccionar con pesos
-                    if processed_choices:
-                        choice_id = f"block_{i}_{hash(choice_block)}"
-                        selected = self._get_weighted_choice(processed_choices, choice_id)
-                        result.append(selected)
-
-                    i = j
-                else:
-                    result.append(text[i])
-                    i += 1
+        current = result
+        # Bloques abiertos: listas de opciones; cada opción es la
+        # lista de fragmentos (tramos de texto y sub-bloques ya resueltos)
+        stack = []
+        # Inicio del tramo de texto literal aún no copiado
+        last = 0
+        # Cada selección ponderada consume exactamente un random()
+        draws = 0
+
+        # Saltar directamente de una llave o '|' a la siguiente
+        for match in _CHOICE_TOKEN_RE.finditer(text):
+            i = match.start()
+            char = match.group()
+            if char != "{" and not stack:
+                continue
+
+            if i > last:
+                current.append(text[last:i])
+            last = i + 1
+
+            if char == "{":
+                current = []
+                stack.append([current])
+            elif char == "|":
+                current = []
+                stack[-1].append(current)
             else:
-                result.append(text[i])
-                i += 1
+                options = stack.pop()
+                if not options[-1]:
+                    options.pop()
+
+                current = stack[-1][-1] if stack else result
+
+                # Seleccionar con pesos
+                if options:
+                    choices = tuple(map(join_choice, options))
+                    current.append(weighted_choice(choices))
+                    draws += 1
+                else:
+                    current.append("")
 
-        return "".join(result)
+        if last < len(text):
+            current.append(text[last:])
+
+        # Llaves sin cerrar: se conservan como texto literal. Cada bloque
+        # abierto empieza al final de la última opción del anterior, así que
+        # basta con volcarlos en orden, sin anidar las uniones
+        for options in stack:
+            result.append("{")
+            result.append("|".join(map("".join, options)))
+
+        return "".join(result), draws
+
+    @staticmethod
+    def _join_choice(parts: list[str]) -> str:
+        """Join the fragments of one option, trimming the surrounding
+        whitespace of the option text itself (not of nested results)."""
+        if len(parts) < 2:
+            return parts[0].strip() if parts else ""
+        # Los sub-bloques resueltos ya vienen sin espacios en los extremos
+        return parts[0].lstrip() + "".join(parts[1:-1]) + parts[-1].rstrip()
+
+    @staticmethod
+    def _strip_comments(text: str) -> str:
+        """Remove // line comments and /* block comments */"""
+        if "/" not in text:
+            return text
+        return _COMMENT_RE.sub("", text)
 
     def _limit_blank_lines(self, text: str, max_consecutive: int = 3) -> str:
         """Reduce múltiples líneas en blanco consecutivas al límite dado."""
-        pattern = r"(\n\s*){" + str(max_consecutive + 1) + r",}"
+        # El patrón necesita al menos max_consecutive + 1 saltos de línea
+        # (las líneas "en blanco" pueden tener espacios, así que se cuentan)
+        if text.count("\n") <= max_consecutive:
+            return text
+
+        pattern = _BLANK_LINES_RE_CACHE.get(max_consecutive)
+        if pattern is None:
+            pattern = re.compile(r"(\n\s*){" + str(max_consecutive + 1) + r",}")
+            _BLANK_LINES_RE_CACHE[max_consecutive] = pattern
         replacement = "\n" * max_consecutive
-        return re.sub(pattern, replacement, text)
+        return pattern.sub(replacement, text)
 
     @classmethod
     def INPUT_TYPES(cls):
@@ -212,11 +352,12 @@ class RandomPromptsMyTest:
 
     def generate(self, text: str, seed: int, max_blank_lines: int, autorefresh: str) -> Tuple[str]:
         """Main generation function"""
+        self._fresh_seed = None
         if seed > 0:
             if seed != self._last_seed:
                 self._random.seed(seed)
                 self._last_seed = seed
-                self._reset_history()
+                self._fresh_seed = seed
         else:
             self._random.seed(int(time.time() * 1000) % (2**32))
 
@@ -224,6 +365,9 @@ class RandomPromptsMyTest:
             # Procesar comodines primero
             text = self._process_wildcards(text)
             
+            # Eliminar comentarios una sola vez, antes de las elecciones
+            text = self._strip_comments(text)
+
             # Luego procesar elecciones
             result = self._process_choices(text)
 